@@ -1,10 +1,27 @@
-import requests
-import json
+import httpx
+import orjson
+import numpy as np
+try:
+    import simdjson
+except ImportError:  # pysimdjson es opcional: sin él se usa orjson
+    simdjson = None
+import tiktoken
+import hashlib
 import re
+import sys
+import threading
+import time
+import zlib
 import streamlit as st
+from collections import OrderedDict
 from datetime import datetime
+from itertools import chain, islice
 from openai import OpenAI
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+import cache
 
 # Configuración de la página
 st.set_page_config(
@@ -22,68 +39,155 @@ if "current_analysis" not in st.session_state:
     st.session_state.current_analysis = None
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = []
+if "current_post_content_z" not in st.session_state:
+    st.session_state.current_post_content_z = None
+if "semantic_cache" not in st.session_state:
+    st.session_state.semantic_cache = {}
+
+# Una sola alternancia compilada al importar: la URL se recorre una vez
+_POST_ID_RE = re.compile(r'(?:reddit\.com/r/[^/]+/comments/|redd\.it/|/comments/)([a-z0-9]+)')
 
 def extract_post_id_from_url(url):
     """Extrae el ID del post de una URL de Reddit"""
-    patterns = [
-        r'reddit\.com/r/[^/]+/comments/([a-z0-9]+)',
-        r'redd\.it/([a-z0-9]+)',
-        r'/comments/([a-z0-9]+)'
-    ]
-    for pattern in patterns:
-        match = re.search(pattern, url)
-        if match:
-            return match.group(1)
-    return None
+    match = _POST_ID_RE.search(url)
+    return match.group(1) if match else None
+
+# Una entrada por API key: acotada para no retener claves de usuarios pasados
+@st.cache_resource(max_entries=32, ttl=3600)
+def get_openai_client(api_key):
+    """Cliente de OpenAI por API key; reutiliza su pool de conexiones entre reruns"""
+    return OpenAI(api_key=api_key)
+
+@st.cache_resource
+def get_http_client():
+    """Cliente HTTP compartido entre reruns: HTTP/2 y keep-alive reutilizan TCP/TLS"""
+    # Se resuelve en el hilo del script y se pasa a los fetchers
+    return httpx.Client(
+        http2=True,
+        timeout=15,
+        follow_redirects=True,
+        limits=httpx.Limits(max_connections=8, max_keepalive_connections=4),
+        headers={"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"}
+    )
+
+_RETRY_STATUS = (429, 500, 502, 503, 504)
+# Post borrado o bloqueado: ningún proxy ni reintento lo va a arreglar
+_TERMINAL_STATUS = (404, 451)
+_MAX_BACKOFF = 30  # segundos
+
+class PostUnavailableError(Exception):
+    """Reddit indica que el post no existe o no se puede servir"""
+
+def _get_with_retries(http, url, retries=2):
+    """GET con reintentos ante 429/5xx o errores de red"""
+    # El primer intento sale sin espera; solo se duerme tras un fallo
+    backoff = 1
+    for attempt in range(retries + 1):
+        try:
+            response = http.get(url)
+        except httpx.TransportError:
+            if attempt == retries:
+                raise
+        else:
+            if response.status_code not in _RETRY_STATUS or attempt == retries:
+                return response
+        time.sleep(backoff)
+        backoff = min(backoff * 2, _MAX_BACKOFF)
 
-def get_post_via_proxy(post_id, include_comments=True, max_comments=15):
-    """Obtiene el post usando un proxy para evitar bloqueos"""
-    reddit_url = f"https://www.reddit.com/comments/{post_id}.json"
+# Reddit cuenta en `limit` los comentarios borrados y los fijados de AutoModerator,
+# que luego se descartan: se pide margen y islice hace de tope real
+_COMMENT_LIMIT_HEADROOM = 10
+
+def _reddit_json_url(post_id, include_comments, max_comments):
+    """URL del JSON del post pidiendo a Reddit solo los comentarios que se van a usar"""
+    # sort=top trae primero los comentarios con más score, los mismos que
+    # conservamos al recortar el contexto; limit=0 omite el árbol de comentarios
+    # y depth=1 las respuestas anidadas, que nunca se usan
+    limit = max_comments + _COMMENT_LIMIT_HEADROOM if include_comments else 0
+    return f"https://www.reddit.com/comments/{post_id}.json?raw_json=1&limit={limit}&depth=1&sort=top"
+
+def _loads_reddit_json(content):
+    """Parsea la respuesta de Reddit; con simdjson los nodos solo se crean al acceder"""
+    if simdjson is not None:
+        # Un parser por documento: reutilizarlo invalidaría el anterior
+        return simdjson.Parser().parse(content)
+    return orjson.loads(content)
+
+# Los fetchers se ejecutan en hilos secundarios: no deben llamar a st.*
+def get_post_via_proxy(http, post_id, include_comments=True, max_comments=15):
+    """Obtiene el JSON del post usando un proxy para evitar bloqueos"""
+    reddit_url = _reddit_json_url(post_id, include_comments, max_comments)
     
     # Método 1: Usar AllOrigins (proxy gratuito)
     proxy_url = f"https://api.allorigins.win/raw?url={urllib.parse.quote(reddit_url)}"
     
     try:
-        with st.spinner("🌐 Obteniendo post via proxy..."):
-            response = requests.get(proxy_url, timeout=15)
+        response = _get_with_retries(http, proxy_url)
+        
+        if response.status_code == 200:
+            return _loads_reddit_json(response.content)
+        elif response.status_code in _TERMINAL_STATUS:
+            raise PostUnavailableError(response.status_code)
+        else:
+            return None
             
-            if response.status_code == 200:
-                try:
-                    data = response.json()
-                    return process_reddit_data(data, include_comments, max_comments)
-                except json.JSONDecodeError:
-                    st.error("Error decodificando la respuesta. Intenta con otro post o usa el modo manual.")
-                    return None
-            else:
-                return None
-                
-    except Exception as e:
-        st.error(f"Error con proxy: {str(e)}")
+    except PostUnavailableError:
+        raise
+    except Exception:
         return None
 
-def get_post_via_cors_proxy(post_id, include_comments=True, max_comments=15):
+def get_post_via_cors_proxy(http, post_id, include_comments=True, max_comments=15):
     """Método alternativo usando otro proxy"""
-    reddit_url = f"https://www.reddit.com/comments/{post_id}.json"
+    reddit_url = _reddit_json_url(post_id, include_comments, max_comments)
     
     # Método 2: Usar corsproxy.io
     proxy_url = f"https://corsproxy.io/?{urllib.parse.quote(reddit_url)}"
     
     try:
-        with st.spinner("🌐 Intentando método alternativo..."):
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
-            }
-            response = requests.get(proxy_url, headers=headers, timeout=15)
+        response = _get_with_retries(http, proxy_url)
+        
+        if response.status_code == 200:
+            return _loads_reddit_json(response.content)
+        elif response.status_code in _TERMINAL_STATUS:
+            raise PostUnavailableError(response.status_code)
+        else:
+            return None
             
-            if response.status_code == 200:
-                data = response.json()
-                return process_reddit_data(data, include_comments, max_comments)
-            else:
-                return None
-                
+    except PostUnavailableError:
+        raise
     except Exception:
         return None
 
+# Tope global de la carrera: los reintentos no pueden alargar la espera sin límite
+PROXY_RACE_TIMEOUT = 16  # segundos
+
+def _fetch_first_available(http, post_id, include_comments, max_comments):
+    """Lanza ambos proxies en paralelo y devuelve el primer JSON válido"""
+    fetchers = (get_post_via_proxy, get_post_via_cors_proxy)
+    pool = ThreadPoolExecutor(max_workers=len(fetchers))
+    try:
+        futures = [
+            pool.submit(fetcher, http, post_id, include_comments, max_comments)
+            for fetcher in fetchers
+        ]
+        for future in as_completed(futures, timeout=PROXY_RACE_TIMEOUT):
+            try:
+                data = future.result()
+            except PostUnavailableError:
+                # Error definitivo: no tiene sentido esperar al otro proxy
+                return None
+            if data is not None:
+                return data
+        return None
+    except FuturesTimeoutError:
+        return None
+    finally:
+        # No esperar al proxy más lento
+        pool.shutdown(wait=False, cancel_futures=True)
+
+COMMENTS_HEADER = "\n\nCOMENTARIOS PRINCIPALES:\n"
+_SKIPPED_BODIES = ("[deleted]", "[removed]")
+
 def process_reddit_data(data, include_comments=True, max_comments=15):
     """Procesa los datos JSON de Reddit"""
     try:
@@ -91,7 +195,7 @@ def process_reddit_data(data, include_comments=True, max_comments=15):
         subreddit = post_data.get("subreddit", "")
         score = post_data.get("score", 0)
         
-        post_content = f"""
+        header = f"""
 TÍTULO: {post_data.get('title', '')}
 CONTENIDO: {post_data.get('selftext', 'Sin contenido adicional')}
 SCORE: {score} votos
@@ -99,35 +203,41 @@ COMENTARIOS: {post_data.get('num_comments', 0)} comentarios
 URL: https://reddit.com{post_data.get('permalink', '')}
 SUBREDDIT: r/{subreddit}
 """
+        post_content = header
+        comment_blocks = []
         
         if include_comments and len(data) > 1:
             comments_data = data[1]["data"]["children"]
-            comment_section = "\n\nCOMENTARIOS PRINCIPALES:\n"
-            comment_count = 0
-            
-            for comment in comments_data:
-                if comment.get("kind") != "t1":
-                    continue
-                comment_data = comment.get("data", {})
-                comment_body = comment_data.get("body", "")
-                comment_score = comment_data.get("score", 0)
-                
-                if comment_body and comment_body not in ["[deleted]", "[removed]"]:
-                    comment_section += f"\n--- COMENTARIO {comment_count + 1} (Score: {comment_score}) ---\n"
-                    comment_section += f"{comment_body}\n"
-                    comment_count += 1
-                
-                if comment_count >= max_comments:
-                    break
+            # Nombres locales: el generador los lee como celdas, no como globales
+            skipped_bodies = _SKIPPED_BODIES
+            # Un hijo sin "data" se descarta sin invalidar el resto del post
+            valid_comments = (
+                comment_data
+                for comment_data in (c.get("data") for c in comments_data if c.get("kind") == "t1")
+                # Comprobación de verdad: descarta también "" y "body": null
+                if comment_data and (body := comment_data.get("body")) and body not in skipped_bodies
+            )
+            # sort=top ya los trae por score; reordenar los elegidos cubre los fijados
+            top_comments = sorted(
+                islice(valid_comments, max_comments),
+                key=lambda c: c.get("score", 0),
+                reverse=True
+            )
+            for i, comment_data in enumerate(top_comments, 1):
+                comment_blocks.append(
+                    f"\n--- COMENTARIO {i} (Score: {comment_data.get('score', 0)}) ---\n{comment_data['body']}\n"
+                )
             
-            if comment_count > 0:
-                post_content += comment_section
+            if comment_blocks:
+                post_content += COMMENTS_HEADER + "".join(comment_blocks)
             else:
                 post_content += "\n\nNo hay comentarios disponibles."
         
         return {
             'title': post_data.get('title', ''),
             'content': post_content,
+            'header': header,
+            'comment_blocks': comment_blocks,
             'score': score,
             'url': f"https://reddit.com{post_data.get('permalink', '')}",
             'subreddit': subreddit
@@ -136,16 +246,38 @@ SUBREDDIT: r/{subreddit}
         st.error(f"Error procesando datos: {str(e)}")
         return None
 
-def get_post_by_id(post_id, include_comments=True, max_comments=15):
-    """Intenta obtener el post con varios métodos"""
-    # Intentar con proxy primero
-    result = get_post_via_proxy(post_id, include_comments, max_comments)
+POST_CACHE_TTL = 600  # segundos
+
+@st.cache_data(ttl=POST_CACHE_TTL, max_entries=128, show_spinner=False)
+def _fetch_post_raw(post_id, include_comments, max_comments):
+    """Descarga y procesa el post; devuelve (post, fetched_at) y se cachea 10 min por sus argumentos"""
+    # Tras un reinicio la caché en memoria está vacía: probar antes la de disco
+    cached = cache.get_post(post_id, include_comments, max_comments, POST_CACHE_TTL)
+    if cached:
+        return cached
     
-    if not result:
-        # Si falla, intentar con proxy alternativo
-        result = get_post_via_cors_proxy(post_id, include_comments, max_comments)
+    data = _fetch_first_available(get_http_client(), post_id, include_comments, max_comments)
+    result = process_reddit_data(data, include_comments, max_comments) if data else None
     
     if not result:
+        # Las excepciones no se cachean: así un fallo no bloquea reintentos
+        raise LookupError(post_id)
+    
+    cache.set_post(post_id, include_comments, max_comments, result, POST_CACHE_TTL)
+    return result, time.time()
+
+def get_post_by_id(post_id, include_comments=True, max_comments=15):
+    """Intenta obtener el post con varios métodos"""
+    result = None
+    try:
+        with st.spinner("🌐 Obteniendo post via proxy..."):
+            result, fetched_at = _fetch_post_raw(post_id, include_comments, max_comments)
+            if time.time() - fetched_at > POST_CACHE_TTL:
+                # Entrada rellenada desde disco: su TTL en memoria empezó después de la
+                # descarga, así que se descarta para no superar los 10 min en total
+                _fetch_post_raw.clear(post_id, include_comments, max_comments)
+                result, _ = _fetch_post_raw(post_id, include_comments, max_comments)
+    except LookupError:
         st.error("""
         ❌ No se pudo obtener el post automáticamente.
         
@@ -157,34 +289,289 @@ def get_post_by_id(post_id, include_comments=True, max_comments=15):
     
     return result
 
-def analyze_post(client, post_content, analysis_prompt=""):
-    """Analiza el contenido del post usando OpenAI"""
-    if not analysis_prompt:
-        analysis_prompt = "Identifica y resume los subtemas principales"
-    
-    with st.spinner("🤖 Analizando contenido..."):
-        try:
-            prompt = f"""
-Analiza este texto de Reddit y responde:
+# Instrucciones fijas: al ir primero y sin cambios entre llamadas,
+# OpenAI puede reutilizar el prefijo cacheado del prompt
+ANALYSIS_INSTRUCTIONS = """Analiza el texto de Reddit que te envía el usuario y responde:
 
 1. ¿Cuál es el tema principal? (en 5-10 palabras)
 2. ¿Hay una pregunta principal? (sí/no y cuál)
 3. Lista los subtemas detectados con un titular y resumen en bullets
 
-El análisis debe centrarse en: {analysis_prompt}
+Centra el análisis en el foco indicado al final del mensaje."""
 
-CONTENIDO:
-{post_content}
-"""
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=2000,
-                temperature=0.3
-            )
-            return response.choices[0].message.content
-        except Exception as e:
-            return f"❌ Error en análisis: {str(e)}"
+# El contenido va antes que el foco: al iterar sobre el mismo post con
+# distintos focos, el prefijo compartido incluye todo el post
+_ANALYSIS_TEMPLATE = "CONTENIDO:\n{content}\n\nFoco: {aspect}"
+
+CHAT_INSTRUCTIONS = """Respondes preguntas sobre el post de Reddit y el análisis previo que siguen.
+Responde basándote solo en la información disponible."""
+
+# Marca con la que el modelo pide el texto original cuando el análisis no basta
+NEEDS_FULL_TEXT = "NECESITO_TEXTO_COMPLETO"
+
+CHAT_SUMMARY_INSTRUCTIONS = f"""Respondes preguntas sobre un post de Reddit a partir del análisis previo que sigue.
+Responde basándote solo en la información disponible.
+Si la respuesta requiere el texto original del post, responde únicamente {NEEDS_FULL_TEXT}."""
+
+def _cache_key(*parts):
+    """Clave BLAKE2b de 128 bits para cachear respuestas del modelo"""
+    return hashlib.blake2b("||".join(parts).encode(), digest_size=16).hexdigest()
+
+RESPONSE_CACHE_TTL = 3600  # segundos
+RESPONSE_CACHE_MAX_ENTRIES = 256
+
+@st.cache_resource
+def _response_cache():
+    """Caché en memoria de respuestas del modelo, compartida entre sesiones"""
+    # Cada sesión corre en su propio hilo: el lock protege la expulsión
+    return OrderedDict(), threading.Lock()
+
+def _get_cached_response(key):
+    """Devuelve la respuesta cacheada si existe y no ha caducado"""
+    entries, _ = _response_cache()
+    entry = entries.get(key)
+    if entry and time.time() - entry[0] < RESPONSE_CACHE_TTL:
+        return entry[1]
+    return None
+
+def _store_response(key, text):
+    """Guarda una respuesta completa, expulsando la más antigua si se supera el tope"""
+    entries, lock = _response_cache()
+    with lock:
+        entries[key] = (time.time(), text)
+        entries.move_to_end(key)
+        while len(entries) > RESPONSE_CACHE_MAX_ENTRIES:
+            entries.popitem(last=False)
+
+def _stream_completion(client, messages, max_tokens, sentinel=None):
+    """Muestra la respuesta con st.write_stream según llegan los tokens; None si empieza por `sentinel`"""
+    response = client.chat.completions.create(
+        model="gpt-4o-mini",
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=0.3,
+        stream=True
+    )
+    chunks = (chunk.choices[0].delta.content or "" for chunk in response if chunk.choices)
+    if sentinel:
+        # No se pinta nada mientras la respuesta todavía pueda ser el centinela
+        head = []
+        for text in chunks:
+            head.append(text)
+            start = "".join(head).lstrip()
+            if start.startswith(sentinel):
+                response.close()
+                return None
+            if not sentinel.startswith(start):
+                break
+        chunks = chain(["".join(head)], chunks)
+    return st.write_stream(chunks)
+
+DEFAULT_ANALYSIS_PROMPT = "Identifica y resume los subtemas principales"
+
+def _analysis_messages(post_content, analysis_prompt):
+    """Mensajes del análisis: instrucciones fijas, contenido y foco al final"""
+    return [
+        {"role": "system", "content": ANALYSIS_INSTRUCTIONS},
+        {"role": "user", "content": _ANALYSIS_TEMPLATE.format_map({"content": post_content, "aspect": analysis_prompt})}
+    ]
+
+def _post_key(post_id, include_comments, max_comments):
+    """Identificador estable del post: no cambia cuando varían los scores en vivo"""
+    return f"reddit:{post_id}:{int(include_comments)}:{max_comments}"
+
+def _analysis_key(post_content, analysis_prompt):
+    """Clave de caché de un análisis"""
+    return _cache_key(post_content, analysis_prompt, "gpt-4o-mini", "0.3")
+
+def _remember_analysis(post_content, analysis_prompt, analysis):
+    """Guarda el análisis en memoria y en disco"""
+    _store_response(_analysis_key(post_content, analysis_prompt), analysis)
+    cache.set_analysis(post_content, analysis_prompt, "gpt-4o-mini", analysis, RESPONSE_CACHE_TTL)
+
+def analyze_post(client, post_content, analysis_prompt="", post_key=None):
+    """Analiza el contenido del post usando OpenAI"""
+    if not analysis_prompt:
+        analysis_prompt = DEFAULT_ANALYSIS_PROMPT
+    
+    content_hash = _analysis_key(post_content, analysis_prompt)
+    cached = _get_cached_response(content_hash)
+    if cached is not None:
+        return cached
+    
+    cached = cache.get_analysis(post_content, analysis_prompt, "gpt-4o-mini", RESPONSE_CACHE_TTL)
+    if cached is None and post_key:
+        # Resultado de la Batch API: guardado por post y vigente lo mismo que un post descargado
+        cached = cache.get_analysis(post_key, analysis_prompt, "gpt-4o-mini", POST_CACHE_TTL)
+    if cached is not None:
+        _store_response(content_hash, cached)
+        return cached
+    
+    placeholder = st.empty()
+    try:
+        messages = _analysis_messages(post_content, analysis_prompt)
+        with placeholder:
+            analysis = _stream_completion(client, messages, 2000)
+        _remember_analysis(post_content, analysis_prompt, analysis)
+        return analysis
+    except Exception as e:
+        return f"❌ Error en análisis: {str(e)}"
+    finally:
+        # El resultado se muestra en la sección de resultados
+        placeholder.empty()
+
+def fetch_posts_bulk(post_ids, include_comments=True, max_comments=15):
+    """Descarga varios posts en paralelo; devuelve {post_id: post} con los obtenidos"""
+    http = get_http_client()
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        raw = list(pool.map(
+            lambda post_id: _fetch_first_available(http, post_id, include_comments, max_comments),
+            post_ids
+        ))
+    
+    posts = {}
+    for post_id, data in zip(post_ids, raw):
+        post = process_reddit_data(data, include_comments, max_comments) if data else None
+        if post:
+            posts[post_id] = post
+            cache.set_post(post_id, include_comments, max_comments, post, POST_CACHE_TTL)
+    return posts
+
+def submit_analysis_batch(client, posts, analysis_prompt=""):
+    """Envía los análisis a la Batch API de OpenAI (~50% más barata, resultados en <24 h)"""
+    if not analysis_prompt:
+        analysis_prompt = DEFAULT_ANALYSIS_PROMPT
+    
+    lines = []
+    for post_id, post in posts.items():
+        lines.append(orjson.dumps({
+            "custom_id": post_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": "gpt-4o-mini",
+                "messages": _analysis_messages(post['content'], analysis_prompt),
+                "max_tokens": 2000,
+                "temperature": 0.3
+            }
+        }))
+    
+    batch_file = client.files.create(file=("analisis.jsonl", b"\n".join(lines)), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    return batch.id
+
+def fetch_batch_results(client, batch_id, analysis_prompt="", include_comments=True, max_comments=15):
+    """Devuelve (estado, {post_id: análisis}); los análisis solo cuando el lote terminó"""
+    if not analysis_prompt:
+        analysis_prompt = DEFAULT_ANALYSIS_PROMPT
+    
+    batch = client.batches.retrieve(batch_id)
+    if batch.status != "completed" or not batch.output_file_id:
+        return batch.status, {}
+    
+    results = {}
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line:
+            continue
+        item = orjson.loads(line)
+        response = item.get("response") or {}
+        if response.get("status_code") != 200:
+            continue
+        post_id = item["custom_id"]
+        analysis = response["body"]["choices"][0]["message"]["content"]
+        results[post_id] = analysis
+        # Por post y no por contenido: al analizarlo en la app se habrá vuelto a
+        # descargar con otros scores. analyze_post solo lo usa como respaldo
+        cache.set_analysis(
+            _post_key(post_id, include_comments, max_comments), analysis_prompt, "gpt-4o-mini", analysis,
+            RESPONSE_CACHE_TTL
+        )
+    return batch.status, results
+
+SEMANTIC_CACHE_THRESHOLD = 0.92
+
+def _embed_question(client, question):
+    """Embedding normalizado de la pregunta, o None si la llamada falla"""
+    try:
+        response = client.embeddings.create(model="text-embedding-3-small", input=question)
+    except Exception:
+        return None
+    vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def _semantic_lookup(context_key, vector):
+    """Respuesta a una pregunta parecida (coseno > umbral) sobre el mismo contexto"""
+    entries = st.session_state.semantic_cache.get(context_key)
+    if vector is None or not entries:
+        return None
+    scores = np.stack([entry[0] for entry in entries]) @ vector
+    best = int(np.argmax(scores))
+    return entries[best][1] if scores[best] > SEMANTIC_CACHE_THRESHOLD else None
+
+def _semantic_store(context_key, vector, answer):
+    """Guarda la respuesta asociada al embedding de su pregunta"""
+    if vector is not None:
+        st.session_state.semantic_cache.setdefault(context_key, []).append((vector, answer))
+
+@st.cache_resource
+def _get_encoding():
+    """Tokenizador de gpt-4o-mini (se carga una sola vez por proceso)"""
+    return tiktoken.encoding_for_model("gpt-4o-mini")
+
+def trim_post_content(post, budget):
+    """Recorta el post a `budget` tokens: cabecera + comentarios con más score"""
+    enc = _get_encoding()
+    tokens = enc.encode(post['content'])
+    if len(tokens) <= budget:
+        return post['content']
+    
+    header = post.get('header')
+    if header is None:
+        # Entrada manual: no hay comentarios separables, se corta el texto
+        return enc.decode(tokens[:budget])
+    
+    header_tokens = enc.encode(header + COMMENTS_HEADER)
+    if len(header_tokens) >= budget:
+        return enc.decode(header_tokens[:budget])
+    
+    parts = [header, COMMENTS_HEADER]
+    used = len(header_tokens)
+    for block in post['comment_blocks']:
+        block_tokens = len(enc.encode(block))
+        if used + block_tokens > budget:
+            break
+        parts.append(block)
+        used += block_tokens
+    return "".join(parts)
+
+# Turnos previos que se reenvían al modelo en cada pregunta
+CHAT_HISTORY_MESSAGES = 10
+
+def _answer_question(client, post, analysis, history, question, context_budget):
+    """Responde con el análisis y, solo si el modelo lo pide, con el texto del post"""
+    # El mensaje de sistema es idéntico en todos los turnos del mismo post, así que
+    # siempre es prefijo cacheable por OpenAI. El historial solo se suma a ese
+    # prefijo hasta CHAT_HISTORY_MESSAGES: después la ventana se desplaza
+    turns = [*history, {"role": "user", "content": question}]
+    
+    # Nivel 1: análisis + título, suficiente para la mayoría de preguntas
+    summary_context = f"{CHAT_SUMMARY_INSTRUCTIONS}\n\nTÍTULO: {post['title']}\n\nANÁLISIS:\n{analysis}"
+    answer = _stream_completion(
+        client,
+        [{"role": "system", "content": summary_context}, *turns],
+        1000,
+        sentinel=NEEDS_FULL_TEXT
+    )
+    if answer is not None:
+        return answer
+    
+    # Nivel 2: post recortado al presupuesto de tokens
+    stable_context = f"{CHAT_INSTRUCTIONS}\n\nPOST:\n{trim_post_content(post, context_budget)}\n\nANÁLISIS:\n{analysis}"
+    return _stream_completion(client, [{"role": "system", "content": stable_context}, *turns], 1000)
 
 def generate_txt_export(post_data, analysis, chat_history):
     """Genera contenido TXT para descargar"""
@@ -208,17 +595,157 @@ Score: {post_data['score']} votos
 """
     
     if chat_history:
-        content += "\n\n💬 HISTORIAL DE CHAT:\n"
-        content += "=" * 40 + "\n"
+        parts = [content, "\n\n💬 HISTORIAL DE CHAT:\n", "=" * 40 + "\n"]
         for msg in chat_history:
-            if "user" in msg:
-                content += f"\n👤 Usuario: {msg['user']}\n"
-            elif "assistant" in msg:
-                content += f"\n🤖 Asistente: {msg['assistant']}\n"
-            content += "-" * 40
+            if msg["role"] == "user":
+                parts.append(f"\n👤 Usuario: {msg['content']}\n")
+            elif msg["role"] == "assistant":
+                parts.append(f"\n🤖 Asistente: {msg['content']}\n")
+            parts.append("-" * 40)
+        content = "".join(parts)
     
     return content
 
+# Texto del post que se guarda comprimido en la sesión
+_POST_TEXT_FIELDS = ('content', 'header', 'comment_blocks')
+SESSION_CACHE_CAP = 2 * 1024 * 1024  # bytes
+
+def _pack_post(post):
+    """Separa el post en (metadatos, texto comprimido con zlib)"""
+    text = {field: post[field] for field in _POST_TEXT_FIELDS if field in post}
+    meta = {k: v for k, v in post.items() if k not in _POST_TEXT_FIELDS}
+    return meta, zlib.compress(orjson.dumps(text), 3)
+
+def _unpack_post(meta, blob):
+    """Reconstruye el post completo a partir de _pack_post"""
+    post = dict(meta)
+    post.update(orjson.loads(zlib.decompress(blob)))
+    return post
+
+def set_current_post(post):
+    """Guarda el post en sesión: metadatos en claro y texto comprimido con zlib"""
+    st.session_state.current_post, st.session_state.current_post_content_z = _pack_post(post)
+
+def get_current_post():
+    """Reconstruye el post completo descomprimiendo su texto"""
+    return _unpack_post(st.session_state.current_post, st.session_state.current_post_content_z)
+
+def reset_session_data():
+    """Libera el post, el análisis, el chat y las cachés de la sesión"""
+    st.session_state.current_post_id = None
+    st.session_state.current_post = None
+    st.session_state.current_post_content_z = None
+    st.session_state.current_analysis = None
+    st.session_state.chat_history = []
+    st.session_state.semantic_cache = {}
+    st.session_state.pop("txt_export", None)
+    st.session_state.pop("bulk_batch", None)
+
+def evict_session_caches():
+    """Vacía la caché semántica de la sesión si supera SESSION_CACHE_CAP"""
+    size = sum(
+        vector.nbytes + sys.getsizeof(answer)
+        for entries in st.session_state.semantic_cache.values()
+        for vector, answer in entries
+    )
+    if size > SESSION_CACHE_CAP:
+        st.session_state.semantic_cache = {}
+
+def get_txt_export():
+    """Devuelve el TXT de la sesión, regenerándolo solo si cambió post, análisis o chat"""
+    chat_history = st.session_state.chat_history
+    # Los objetos se comparan primero por identidad, así que la comprobación es barata
+    signature = (
+        st.session_state.current_post,
+        st.session_state.current_post_content_z,
+        st.session_state.current_analysis,
+        chat_history,
+        len(chat_history)
+    )
+    cached = st.session_state.get("txt_export")
+    if cached is None or cached[0] != signature:
+        content = generate_txt_export(
+            get_current_post(),
+            st.session_state.current_analysis,
+            chat_history
+        )
+        cached = (signature, zlib.compress(content.encode(), 3))
+        st.session_state.txt_export = cached
+    return zlib.decompress(cached[1]).decode()
+
+@st.fragment
+def render_chat(client, context_budget):
+    """Chat del post; como fragmento, la respuesta se genera sin re-ejecutar el resto de la página"""
+    # Chat container
+    chat_container = st.container()
+    with chat_container:
+        for msg in st.session_state.chat_history:
+            with st.chat_message(msg["role"]):
+                st.write(msg["content"])
+    
+    # Input
+    user_input = st.chat_input("Pregunta sobre el post...")
+    
+    if user_input:
+        # Mismo formato que `messages`: se inserta en la llamada sin convertir
+        history = st.session_state.chat_history[-CHAT_HISTORY_MESSAGES:]
+        st.session_state.chat_history.append({"role": "user", "content": user_input})
+        
+        with chat_container:
+            with st.chat_message("user"):
+                st.write(user_input)
+            with st.chat_message("assistant"):
+                try:
+                    post = get_current_post()
+                    analysis = st.session_state.current_analysis
+                    # Re-analizar el mismo post con otro foco o comentarios cambia el contexto
+                    context_key = _cache_key(post['content'], analysis, str(context_budget))
+                    chat_hash = _cache_key(
+                        post['content'],
+                        str(context_budget),
+                        analysis,
+                        orjson.dumps(history).decode(),
+                        user_input,
+                        "gpt-4o-mini",
+                        "0.3"
+                    )
+                    answer = _get_cached_response(chat_hash)
+                    question_vector = None
+                    if answer is None and not history:
+                        # Preguntas reformuladas: el embedding cuesta ~100 veces menos que la respuesta.
+                        # Solo al abrir la conversación: con historial la respuesta depende de él
+                        question_vector = _embed_question(client, user_input)
+                        answer = _semantic_lookup(context_key, question_vector)
+                    
+                    if answer is not None:
+                        st.write(answer)
+                    else:
+                        answer = _answer_question(client, post, analysis, history, user_input, context_budget)
+                        _store_response(chat_hash, answer)
+                        _semantic_store(context_key, question_vector, answer)
+                    st.session_state.chat_history.append({"role": "assistant", "content": answer})
+                    # Rerun completo: la descarga de la pestaña de análisis incluye el chat
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"Error: {str(e)}")
+    
+    # Controles
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("🔄 Limpiar chat", use_container_width=True):
+            st.session_state.chat_history = []
+            st.rerun()
+    with col2:
+        if st.session_state.chat_history:
+            txt_content = get_txt_export()
+            st.download_button(
+                label="📥 Descargar todo",
+                data=txt_content,
+                file_name=f"reddit_completo_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
+                mime="text/plain",
+                use_container_width=True
+            )
+
 # INTERFAZ PRINCIPAL
 st.title("📊 Reddit Post Analyzer - Demo")
 st.markdown("""
@@ -237,11 +764,74 @@ with st.sidebar:
     )
     
     if api_key:
-        client = OpenAI(api_key=api_key)
+        client = get_openai_client(api_key)
         st.success("✅ API Key configurada")
     else:
         st.warning("⚠️ Ingresa tu API Key para continuar")
     
+    context_budget = st.slider(
+        "Presupuesto de contexto (tokens)", 500, 8000, 2000, step=500,
+        help="Máximo de tokens del post que se envían en cada pregunta del chat"
+    )
+    
+    if api_key:
+        with st.expander("📦 Análisis masivo (Batch API)"):
+            bulk_urls = st.text_area("URLs de Reddit (una por línea):")
+            bulk_prompt = st.text_input("Aspecto a analizar (opcional):", key="bulk_prompt")
+            
+            if st.button("📤 Enviar lote", use_container_width=True):
+                post_ids = [
+                    post_id for post_id in
+                    (extract_post_id_from_url(line.strip()) for line in bulk_urls.splitlines() if line.strip())
+                    if post_id
+                ]
+                if post_ids:
+                    with st.spinner("🌐 Obteniendo posts..."):
+                        bulk_posts = fetch_posts_bulk(list(dict.fromkeys(post_ids)))
+                    if bulk_posts:
+                        try:
+                            batch_id = submit_analysis_batch(client, bulk_posts, bulk_prompt)
+                            st.session_state.bulk_batch = {
+                                'id': batch_id,
+                                # Mismo esquema que el post actual: texto comprimido
+                                'posts': {post_id: _pack_post(post) for post_id, post in bulk_posts.items()},
+                                'prompt': bulk_prompt,
+                                'results': {}
+                            }
+                            st.success(f"✅ Lote enviado: {len(bulk_posts)} posts")
+                        except Exception as e:
+                            st.error(f"Error enviando lote: {str(e)}")
+                    else:
+                        st.error("No se pudo obtener ningún post")
+                else:
+                    st.warning("Ingresa al menos una URL válida")
+            
+            bulk_batch = st.session_state.get("bulk_batch")
+            if bulk_batch:
+                st.caption(f"Lote `{bulk_batch['id']}`")
+                if not bulk_batch['results'] and st.button("🔄 Comprobar estado", use_container_width=True):
+                    try:
+                        status, results = fetch_batch_results(client, bulk_batch['id'], bulk_batch['prompt'])
+                        bulk_batch['results'] = results
+                        st.info(f"Estado: {status}")
+                    except Exception as e:
+                        st.error(f"Error consultando lote: {str(e)}")
+                if bulk_batch['results']:
+                    st.download_button(
+                        label="📥 Descargar lote",
+                        data="\n\n".join(
+                            generate_txt_export(_unpack_post(*bulk_batch['posts'][post_id]), analysis, [])
+                            for post_id, analysis in bulk_batch['results'].items()
+                        ),
+                        file_name=f"reddit_lote_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
+                        mime="text/plain",
+                        use_container_width=True
+                    )
+    
+    if st.button("🧹 Liberar memoria de la sesión", use_container_width=True):
+        reset_session_data()
+        st.rerun()
+    
     st.markdown("---")
     st.markdown("""
     ### 📖 Instrucciones:
@@ -255,6 +845,8 @@ with st.sidebar:
     pegar el contenido directamente
     """)
 
+evict_session_caches()
+
 # Tabs principales
 tab1, tab2 = st.tabs(["📝 Analizar Post", "💬 Chat"])
 
@@ -285,8 +877,11 @@ with tab1:
                 if post_id:
                     post = get_post_by_id(post_id, include_comments, max_comments)
                     if post:
-                        analysis = analyze_post(client, post['content'], analysis_prompt)
-                        st.session_state.current_post = post
+                        analysis = analyze_post(
+                            client, post['content'], analysis_prompt,
+                            post_key=_post_key(post_id, include_comments, max_comments)
+                        )
+                        set_current_post(post)
                         st.session_state.current_analysis = analysis
                         st.session_state.current_post_id = post_id
                         st.session_state.chat_history = []
@@ -307,11 +902,7 @@ with tab1:
                 st.info(f"**{st.session_state.current_post['title']}**")
                 st.caption(f"r/{st.session_state.current_post['subreddit']} • {st.session_state.current_post['score']} votos")
             with col2:
-                txt_content = generate_txt_export(
-                    st.session_state.current_post,
-                    st.session_state.current_analysis,
-                    st.session_state.chat_history
-                )
+                txt_content = get_txt_export()
                 st.download_button(
                     label="📥 Descargar",
                     data=txt_content,
@@ -347,7 +938,7 @@ with tab1:
                     }
                     
                     analysis = analyze_post(client, manual_content, analysis_prompt)
-                    st.session_state.current_post = post
+                    set_current_post(post)
                     st.session_state.current_analysis = analysis
                     st.session_state.current_post_id = f"manual_{datetime.now().strftime('%Y%m%d%H%M%S')}"
                     st.session_state.chat_history = []
@@ -368,66 +959,7 @@ with tab2:
         st.markdown(f"### {st.session_state.current_post['title']}")
         st.caption(f"r/{st.session_state.current_post['subreddit']}")
         
-        # Chat container
-        chat_container = st.container()
-        with chat_container:
-            for msg in st.session_state.chat_history:
-                if "user" in msg:
-                    with st.chat_message("user"):
-                        st.write(msg['user'])
-                elif "assistant" in msg:
-                    with st.chat_message("assistant"):
-                        st.write(msg['assistant'])
-        
-        # Input
-        user_input = st.chat_input("Pregunta sobre el post...")
-        
-        if user_input:
-            st.session_state.chat_history.append({"user": user_input})
-            
-            with st.spinner("Pensando..."):
-                try:
-                    prompt = f"""
-Contexto: {st.session_state.current_post['content']}
-
-Análisis previo: {st.session_state.current_analysis}
-
-Pregunta: {user_input}
-
-Responde basándote solo en la información disponible.
-"""
-                    response = client.chat.completions.create(
-                        model="gpt-4o-mini",
-                        messages=[{"role": "user", "content": prompt}],
-                        max_tokens=1000,
-                        temperature=0.3
-                    )
-                    answer = response.choices[0].message.content
-                    st.session_state.chat_history.append({"assistant": answer})
-                    st.rerun()
-                except Exception as e:
-                    st.error(f"Error: {str(e)}")
-        
-        # Controles
-        col1, col2 = st.columns(2)
-        with col1:
-            if st.button("🔄 Limpiar chat", use_container_width=True):
-                st.session_state.chat_history = []
-                st.rerun()
-        with col2:
-            if st.session_state.chat_history:
-                txt_content = generate_txt_export(
-                    st.session_state.current_post,
-                    st.session_state.current_analysis,
-                    st.session_state.chat_history
-                )
-                st.download_button(
-                    label="📥 Descargar todo",
-                    data=txt_content,
-                    file_name=f"reddit_completo_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
-                    mime="text/plain",
-                    use_container_width=True
-                )
+        render_chat(client, context_budget)
 
 # Footer
 st.markdown("---")
@@ -0,0 +1,99 @@
+"""Caché en SQLite para posts y análisis; sobrevive a reinicios de Streamlit"""
+import hashlib
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+import orjson
+
+DB_PATH = os.environ.get("REDDIT_ANALYZER_CACHE_DB", "reddit_cache.sqlite3")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS reddit_post (
+    post_id TEXT NOT NULL,
+    include_comments INTEGER NOT NULL,
+    max_comments INTEGER NOT NULL,
+    json BLOB NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (post_id, include_comments, max_comments)
+);
+CREATE TABLE IF NOT EXISTS analysis (
+    content_hash TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    model TEXT NOT NULL,
+    response TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (content_hash, prompt_hash, model)
+);
+"""
+
+_schema_ready = False
+
+def _connect():
+    """Abre una conexión (una por llamada, así es segura entre hilos)"""
+    global _schema_ready
+    conn = sqlite3.connect(DB_PATH, timeout=5)
+    if not _schema_ready:
+        try:
+            # WAL permite lecturas concurrentes mientras otra sesión escribe
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+        except sqlite3.Error:
+            conn.close()
+            raise
+        _schema_ready = True
+    return conn
+
+def _sha256(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+def get_post(post_id, include_comments, max_comments, ttl):
+    """Devuelve (post, fetched_at) si el post cacheado tiene menos de `ttl` segundos"""
+    try:
+        with closing(_connect()) as conn:
+            row = conn.execute(
+                "SELECT json, fetched_at FROM reddit_post"
+                " WHERE post_id = ? AND include_comments = ? AND max_comments = ? AND fetched_at > ?",
+                (post_id, int(include_comments), max_comments, time.time() - ttl)
+            ).fetchone()
+    except sqlite3.Error:
+        return None
+    return (orjson.loads(row[0]), row[1]) if row else None
+
+def set_post(post_id, include_comments, max_comments, post, ttl):
+    """Guarda el post procesado y borra los que tienen más de `ttl` segundos"""
+    try:
+        with closing(_connect()) as conn, conn:
+            conn.execute("DELETE FROM reddit_post WHERE fetched_at < ?", (time.time() - ttl,))
+            conn.execute(
+                "INSERT OR REPLACE INTO reddit_post VALUES (?, ?, ?, ?, ?)",
+                (post_id, int(include_comments), max_comments, orjson.dumps(post), time.time())
+            )
+    except sqlite3.Error:
+        pass
+
+def get_analysis(content, prompt, model, ttl):
+    """Devuelve el análisis cacheado si tiene menos de `ttl` segundos"""
+    try:
+        with closing(_connect()) as conn:
+            row = conn.execute(
+                "SELECT response FROM analysis"
+                " WHERE content_hash = ? AND prompt_hash = ? AND model = ? AND created_at > ?",
+                (_sha256(content), _sha256(prompt), model, time.time() - ttl)
+            ).fetchone()
+    except sqlite3.Error:
+        return None
+    return row[0] if row else None
+
+def set_analysis(content, prompt, model, response, ttl):
+    """Guarda un análisis completo y borra los que tienen más de `ttl` segundos"""
+    try:
+        with closing(_connect()) as conn, conn:
+            conn.execute("DELETE FROM analysis WHERE created_at < ?", (time.time() - ttl,))
+            conn.execute(
+                "INSERT OR REPLACE INTO analysis VALUES (?, ?, ?, ?, ?)",
+                (_sha256(content), _sha256(prompt), model, response, time.time())
+            )
+    except sqlite3.Error:
+        pass